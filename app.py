@@ -3,22 +3,46 @@ AI-Powered Self-Assessment Report (SAR) Generator
 Streamlit app: สร้าง SAR ตามมาตรฐาน HA ฉบับที่ 5 จากไฟล์ที่อัปโหลด (PDF/DOCX/Excel/CSV/PPTX) + ข้อความเสริม
 """
 
+import asyncio
+import codecs
+import contextlib
+import csv
+import hashlib
 import io
 import os
 from pathlib import Path
-from string import Template
+import posixpath
+import tempfile
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import textwrap
 
 import streamlit as st
-import pandas as pd
+import pypdfium2 as pdfium
 from pypdf import PdfReader
 from docx import Document
 from pptx import Presentation
+from python_calamine import CalamineWorkbook
 from google import genai
+from lxml import etree
+import orjson
 
 # ====== CONFIGS ======
 MAX_ROWS = 300    # จำกัดแถวต่อชีท/ตาราง เพื่อกัน context ล้น
 MAX_COLS = 50     # จำกัดคอลัมน์ต่อชีท/ตาราง
+SPOOL_TO_DISK_BYTES = 32 * 1024 * 1024  # ไฟล์ Excel ที่ใหญ่กว่านี้ให้ calamine อ่านจากไฟล์ชั่วคราวแทนหน่วยความจำ
+PDF_MAX_CHARS = 2_000_000  # อ่าน PDF ถึงประมาณนี้แล้วหยุด (เกินกว่าที่จะส่งเข้า prompt ได้อยู่แล้ว)
+MAX_CONTEXT_TOKENS = 800_000  # งบ token ของข้อมูลจากไฟล์ทั้งหมดใน prompt (ตัดตามสัดส่วนเมื่อเกิน)
+CONTEXT_CACHE_TTL_SECONDS = 3600  # อายุ context cache ของ Gemini (ฐานความรู้ + ข้อมูลนำเข้า)
+CONTEXT_CACHE_MIN_CHARS = 10_000  # ข้อมูลสั้นกว่านี้ไม่ใช้ context cache (ต่ำกว่าขั้นต่ำของ API/ไม่คุ้ม)
+BATCH_INLINE_MAX_BYTES = 19_000_000  # ขนาด prompt รวมสูงสุดของงาน Batch แบบ inline (API จำกัด 20MB เผื่อ overhead)
+REPORT_INLINE_MAX_CHARS = 200_000  # รายงานยาวกว่านี้เก็บเป็นไฟล์ชั่วคราว (session_state เก็บแค่ path)
+REPORT_FILE_MAX_AGE_SECONDS = 24 * 3600  # ไฟล์รายงานชั่วคราวที่เก่ากว่านี้ถูกลบตอนเริ่มแอป
+MAX_ITEMS_PER_CALL = 6  # จำนวนหัวข้อ SAR สูงสุดต่อการเรียก Gemini หนึ่งครั้ง (กรณีเลือกหลายหัวข้อ)
+MAX_CONCURRENT_CALLS = 8  # จำนวนการเรียก Gemini ที่รันพร้อมกันสูงสุด (กันชน RPM quota)
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -84,90 +108,94 @@ st.markdown(
 
 
 # --- Hardcoded Knowledge Base & SAR Items ---
-SAR_ITEMS = {
-    1: "I-1.1ก(1)(2)(3) การชี้นำองค์กรโดยผู้นำระดับสูง",
-    2: "I-1.1ข การสื่อสาร สร้างความผูกพันโดยผู้นำ**",
-    3: "I-1.1ค(1)(2)(3) การสร้างสิ่งแวดล้อมที่เอื้อต่อการพัฒนาและความสำเร็จขององค์กร**",
-    4: "I-1.2ก(1)(2) ระบบกำกับดูแลกิจการ การประเมินผู้นำ/ระบบการนำ",
-    5: "I-1.2ก(3) ระบบกำกับดูแลทางคลินิก**",
-    6: "I-1.2ข(1)(2)(3),ค(1)(2) การปฏิบัติตามกฎหมาย การทำประโยชน์ให้สังคมและการดำเนินงานอย่างมีจริยธรรม",
-    7: "I-2.1ก(1)(2)(3)(4) กระบวนการจัดทำ วางแผนกลยุทธ์และการวิเคราะห์ข้อมูล **",
-    8: "I-2.1ข(1)(2)(3) วัตถุประสงค์เชิงกลยุทธ์ที่ตอบสนองความท้าทาย ความจำเป็นด้านสุขภาพ ความต้องการบริการสุขภาพและการสร้างเสริมสุขภาพ",
-    9: "I-2.2ก(1)(2)(3)(4) การจัดทำแผนปฏิบัติการ การถ่ายทอดสู่การปฏิบัติ และการจัดสรรทรัพยากร**",
-    10: "I-2.2ก(5), ข การกำหนดตัวชี้วัดการติดตามความก้าวหน้า และการทบทวนแผนปฏิบัติการ",
-    11: "I-3.1ก(1) การรับฟัง/เรียนรู้ความต้องการและความคาดหวังของผู้รับบริการแต่ละกลุ่ม**",
-    12: "I-3.1ข(1)(2) การกำหนดกลุ่มผู้ป่วยและบริการสุขภาพ",
-    13: "I-3.2ก(1)(2)(3) การสร้างความสัมพันธ์และจัดการคำร้องเรียน",
-    14: "I-3.2ข(1)(2) การประเมินความพึงพอใจและความผูกพัน",
-    15: "I-3.3 การคุ้มครองสิทธิผู้ป่วย",
-    16: "I-4.1 ก การวัดผลการดำเนินงาน**",
-    17: "I-4.1ข ค การวิเคราะห์ข้อมูล ประเมินผลการดำเนินการ และนำไปใช้ปรับปรุง",
-    18: "I-4.2ก คุณภาพของข้อมูลและสารสนเทศ",
-    19: "I-4.2ข ความรู้ขององค์กร **",
-    20: "I-5.1ก ขีดความสามารถและความเพียงพอของบุคลากร**",
-    21: "I-5.1ข การสนับสนุนการทำงานและสวัสดิภาพของบุคลากร",
-    22: "I-5.1ค สุขภาพและความปลอดภัยของบุคลากร**",
-    23: "I-5.1 ง ชีวิตและความเป็นอยู่ของบุคลากร",
-    24: "I-5.2ก,ข ความผูกพันและวัฒนธรรมองค์กร",
-    25: "I-5.2ค การจัดการผลการปฏิบัติงานและการพัฒนาบุคลากร (Performance Management and Development)**",
-    26: "I-6.1ก ข, I-6.2ก การออกแบบบริการและกระบวนการทำงาน การนำกระบวนการสู่การปฏิบัติ และปรับปรุงกระบวนการทำงาน, ประสิทธิภาพและประสิทธิผล**",
-    27: "I-6.1ค การจัดการเครือข่ายอุปทาน",
-    28: "I-6.1ง การจัดการนวัตกรรม",
-    29: "I-6.1จ การจัดการด้านการเรียนการสอนและการฝึกอบรมทางคลินิกของสถานพยาบาล",
-    30: "I-6.2ข การจัดการระบบสารสนเทศ**",
-    31: "I-6.2ค ความพร้อมสำหรับภาวะภัยพิบัติและภาวะฉุกเฉินต่างๆ **",
-    32: "II-1.1ก(1)(2)(3)(9) ระบบบริหารงานคุณภาพ การประสานงานและบูรณาการ การทำงานเป็นทีม **",
-    33: "II-1.1ก(4)(5)(6)(7)(8) การประเมินตนเองและจัดทำแผนพัฒนาคุณภาพ",
-    34: "II-1.1ข(1)(2)(3)(4) การทบทวนและพัฒนาคุณภาพการให้บริการและการดูแลผู้ป่วย **",
-    35: "II-1.2ก(1) (3) (5) ระบบบริหารความเสี่ยงและความปลอดภัย*,**",
-    36: "II-1.2ก(2) กระบวนการบริหารความเสี่ยง",
-    37: "II-1.2ก(4) การเรียนรู้จากอุบัติการณ์*",
-    38: "II-2.1ก ระบบบริหารการพยาบาล",
-    39: "II-2.1ข ปฏิบัติการทางการพยาบาล",
-    40: "II-2.2 องค์กรแพทย์",
-    41: "II-3.1ก,ข ความปลอดภัยและสวัสดิภาพของโครงสร้างและสิ่งแวดล้อมทางกายภาพ การจัดการกับวัสดุและของเสียอันตราย**",
-    42: "II-3.1ค,ง ความปลอดภัยจากอัคคีภัย **",
-    43: "II-3.2ก,ข เครื่องมือและระบบสาธารณูปโภค",
-    44: "II-3.3ก สิ่งแวดล้อมเพื่อการสร้างเสริมสุขภาพ",
-    45: "II-3.3ข การพิทักษ์สิ่งแวดล้อม",
-    46: "II-4.1ก ระบบป้องกันและควบคุมการติดเชื้อ (Infection Prevention & Control-IPC)",
-    47: "II-4.1ข การเฝ้าระวังและควบคุมการติดเชื้อ**",
-    48: "II-4.2ก การป้องกันการติดเชื้อทั่วไป",
-    49: "II-4.2ข การป้องกันการติดเชื้อในกลุ่มจำเพาะ*",
-    50: "II-5.1 ก,ข ระบบบริหารเวชระเบียน",
-    51: "II-5.2 เวชระเบียนผู้ป่วย",
-    52: "II-6.1 ก การกำกับดูแลการจัดการด้านยา*,**",
-    53: "II-6.1 ข/ค สิ่งแวดล้อมสนับสนุน การจัดหาและเก็บรักษายา",
-    54: "II-6.2 ก การสั่งใช้ยาและการถ่ายทอดคำสั่ง",
-    55: "II-6.2 ข การทบทวนคำสั่ง เตรียม เขียนฉลาก จัดจ่าย และส่งมอบยา",
-    56: "II-6.2 ค การบริหารยาและติตตามผล",
-    57: "II-7.1 บริการรังสีวิทยา/ภาพทางการแพทย์",
-    58: "II-7.2 บริการห้องปฏิบัติการทางการแพทย์/พยาธิวิทยาคลินิก*",
-    59: "II-7.4 ธนาคารเลือดและงานบริการโลหิต*",
-    60: "II-7.3/7.5 พยาธิวิทยากายวิภาค เซลล์วิทยา, นิติเวชศาสตร์และนิติเวชคลินิก",
-    61: "II-8 การเฝ้าระวังโรคและภัยสุขภาพ",
-    62: "II-9 การทำงานกับชุมชน",
-    63: "III-1 ก, ข การเข้าถึงบริการ**",
-    64: "III-1 ค กระบวนการรับผู้ป่วย การให้ข้อมูล และ informed consent",
-    65: "III-2 ก,ข การประเมินผู้ป่วยและการส่งตรวจเพื่อการวินิจฉัยโรค**",
-    66: "III-2 ค การวินิจฉัยโรค*",
-    67: "III-3.1 การวางแผนการดูแลผู้ป่วย",
-    68: "III-3.2 การวางแผนจำหน่าย",
-    69: "III-4.1 การดูแลทั่วไป",
-    70: "III-4.2 การดูแลและบริการที่มีความเสี่ยงสูง **",
-    71: "III-4.3 ก การระงับความรู้สึก",
-    72: "III-4.3 ข การผ่าตัด*",
-    73: "III-4.3 ค อาหารและโภชนบำบัด",
-    74: "III-4.3 ง การดูแลผู้ป่วยระยะประคับประคอง",
-    75: "III-4.3 จ การจัดการความปวด",
-    76: "III-4.3 ฉ การฟื้นฟูสภาพและสมรรถภาพ",
-    77: "III-4.3 ช การดูแลผู้ป่วยโรคไตเรื้อรัง",
-    78: "III-4.3 ซ การแพทย์แผนไทย",
-    79: "III-4.3 ฌ การแพทย์ทางไกล (Tele-Medicine)",
-    80: "III-4.3 ญ. การดูแลสุขภาพของผู้ป่วยที่บ้าน",
-    81: "III-5 การให้ข้อมูลและเสริมพลัง",
-    82: "III-6 การดูแลต่อเนื่อง**"
-}
+# หัวข้อที่ i (1-82) อยู่ที่ SAR_ITEMS[i - 1]
+SAR_ITEMS = (
+    "I-1.1ก(1)(2)(3) การชี้นำองค์กรโดยผู้นำระดับสูง",
+    "I-1.1ข การสื่อสาร สร้างความผูกพันโดยผู้นำ**",
+    "I-1.1ค(1)(2)(3) การสร้างสิ่งแวดล้อมที่เอื้อต่อการพัฒนาและความสำเร็จขององค์กร**",
+    "I-1.2ก(1)(2) ระบบกำกับดูแลกิจการ การประเมินผู้นำ/ระบบการนำ",
+    "I-1.2ก(3) ระบบกำกับดูแลทางคลินิก**",
+    "I-1.2ข(1)(2)(3),ค(1)(2) การปฏิบัติตามกฎหมาย การทำประโยชน์ให้สังคมและการดำเนินงานอย่างมีจริยธรรม",
+    "I-2.1ก(1)(2)(3)(4) กระบวนการจัดทำ วางแผนกลยุทธ์และการวิเคราะห์ข้อมูล **",
+    "I-2.1ข(1)(2)(3) วัตถุประสงค์เชิงกลยุทธ์ที่ตอบสนองความท้าทาย ความจำเป็นด้านสุขภาพ ความต้องการบริการสุขภาพและการสร้างเสริมสุขภาพ",
+    "I-2.2ก(1)(2)(3)(4) การจัดทำแผนปฏิบัติการ การถ่ายทอดสู่การปฏิบัติ และการจัดสรรทรัพยากร**",
+    "I-2.2ก(5), ข การกำหนดตัวชี้วัดการติดตามความก้าวหน้า และการทบทวนแผนปฏิบัติการ",
+    "I-3.1ก(1) การรับฟัง/เรียนรู้ความต้องการและความคาดหวังของผู้รับบริการแต่ละกลุ่ม**",
+    "I-3.1ข(1)(2) การกำหนดกลุ่มผู้ป่วยและบริการสุขภาพ",
+    "I-3.2ก(1)(2)(3) การสร้างความสัมพันธ์และจัดการคำร้องเรียน",
+    "I-3.2ข(1)(2) การประเมินความพึงพอใจและความผูกพัน",
+    "I-3.3 การคุ้มครองสิทธิผู้ป่วย",
+    "I-4.1 ก การวัดผลการดำเนินงาน**",
+    "I-4.1ข ค การวิเคราะห์ข้อมูล ประเมินผลการดำเนินการ และนำไปใช้ปรับปรุง",
+    "I-4.2ก คุณภาพของข้อมูลและสารสนเทศ",
+    "I-4.2ข ความรู้ขององค์กร **",
+    "I-5.1ก ขีดความสามารถและความเพียงพอของบุคลากร**",
+    "I-5.1ข การสนับสนุนการทำงานและสวัสดิภาพของบุคลากร",
+    "I-5.1ค สุขภาพและความปลอดภัยของบุคลากร**",
+    "I-5.1 ง ชีวิตและความเป็นอยู่ของบุคลากร",
+    "I-5.2ก,ข ความผูกพันและวัฒนธรรมองค์กร",
+    "I-5.2ค การจัดการผลการปฏิบัติงานและการพัฒนาบุคลากร (Performance Management and Development)**",
+    "I-6.1ก ข, I-6.2ก การออกแบบบริการและกระบวนการทำงาน การนำกระบวนการสู่การปฏิบัติ และปรับปรุงกระบวนการทำงาน, ประสิทธิภาพและประสิทธิผล**",
+    "I-6.1ค การจัดการเครือข่ายอุปทาน",
+    "I-6.1ง การจัดการนวัตกรรม",
+    "I-6.1จ การจัดการด้านการเรียนการสอนและการฝึกอบรมทางคลินิกของสถานพยาบาล",
+    "I-6.2ข การจัดการระบบสารสนเทศ**",
+    "I-6.2ค ความพร้อมสำหรับภาวะภัยพิบัติและภาวะฉุกเฉินต่างๆ **",
+    "II-1.1ก(1)(2)(3)(9) ระบบบริหารงานคุณภาพ การประสานงานและบูรณาการ การทำงานเป็นทีม **",
+    "II-1.1ก(4)(5)(6)(7)(8) การประเมินตนเองและจัดทำแผนพัฒนาคุณภาพ",
+    "II-1.1ข(1)(2)(3)(4) การทบทวนและพัฒนาคุณภาพการให้บริการและการดูแลผู้ป่วย **",
+    "II-1.2ก(1) (3) (5) ระบบบริหารความเสี่ยงและความปลอดภัย*,**",
+    "II-1.2ก(2) กระบวนการบริหารความเสี่ยง",
+    "II-1.2ก(4) การเรียนรู้จากอุบัติการณ์*",
+    "II-2.1ก ระบบบริหารการพยาบาล",
+    "II-2.1ข ปฏิบัติการทางการพยาบาล",
+    "II-2.2 องค์กรแพทย์",
+    "II-3.1ก,ข ความปลอดภัยและสวัสดิภาพของโครงสร้างและสิ่งแวดล้อมทางกายภาพ การจัดการกับวัสดุและของเสียอันตราย**",
+    "II-3.1ค,ง ความปลอดภัยจากอัคคีภัย **",
+    "II-3.2ก,ข เครื่องมือและระบบสาธารณูปโภค",
+    "II-3.3ก สิ่งแวดล้อมเพื่อการสร้างเสริมสุขภาพ",
+    "II-3.3ข การพิทักษ์สิ่งแวดล้อม",
+    "II-4.1ก ระบบป้องกันและควบคุมการติดเชื้อ (Infection Prevention & Control-IPC)",
+    "II-4.1ข การเฝ้าระวังและควบคุมการติดเชื้อ**",
+    "II-4.2ก การป้องกันการติดเชื้อทั่วไป",
+    "II-4.2ข การป้องกันการติดเชื้อในกลุ่มจำเพาะ*",
+    "II-5.1 ก,ข ระบบบริหารเวชระเบียน",
+    "II-5.2 เวชระเบียนผู้ป่วย",
+    "II-6.1 ก การกำกับดูแลการจัดการด้านยา*,**",
+    "II-6.1 ข/ค สิ่งแวดล้อมสนับสนุน การจัดหาและเก็บรักษายา",
+    "II-6.2 ก การสั่งใช้ยาและการถ่ายทอดคำสั่ง",
+    "II-6.2 ข การทบทวนคำสั่ง เตรียม เขียนฉลาก จัดจ่าย และส่งมอบยา",
+    "II-6.2 ค การบริหารยาและติตตามผล",
+    "II-7.1 บริการรังสีวิทยา/ภาพทางการแพทย์",
+    "II-7.2 บริการห้องปฏิบัติการทางการแพทย์/พยาธิวิทยาคลินิก*",
+    "II-7.4 ธนาคารเลือดและงานบริการโลหิต*",
+    "II-7.3/7.5 พยาธิวิทยากายวิภาค เซลล์วิทยา, นิติเวชศาสตร์และนิติเวชคลินิก",
+    "II-8 การเฝ้าระวังโรคและภัยสุขภาพ",
+    "II-9 การทำงานกับชุมชน",
+    "III-1 ก, ข การเข้าถึงบริการ**",
+    "III-1 ค กระบวนการรับผู้ป่วย การให้ข้อมูล และ informed consent",
+    "III-2 ก,ข การประเมินผู้ป่วยและการส่งตรวจเพื่อการวินิจฉัยโรค**",
+    "III-2 ค การวินิจฉัยโรค*",
+    "III-3.1 การวางแผนการดูแลผู้ป่วย",
+    "III-3.2 การวางแผนจำหน่าย",
+    "III-4.1 การดูแลทั่วไป",
+    "III-4.2 การดูแลและบริการที่มีความเสี่ยงสูง **",
+    "III-4.3 ก การระงับความรู้สึก",
+    "III-4.3 ข การผ่าตัด*",
+    "III-4.3 ค อาหารและโภชนบำบัด",
+    "III-4.3 ง การดูแลผู้ป่วยระยะประคับประคอง",
+    "III-4.3 จ การจัดการความปวด",
+    "III-4.3 ฉ การฟื้นฟูสภาพและสมรรถภาพ",
+    "III-4.3 ช การดูแลผู้ป่วยโรคไตเรื้อรัง",
+    "III-4.3 ซ การแพทย์แผนไทย",
+    "III-4.3 ฌ การแพทย์ทางไกล (Tele-Medicine)",
+    "III-4.3 ญ. การดูแลสุขภาพของผู้ป่วยที่บ้าน",
+    "III-5 การให้ข้อมูลและเสริมพลัง",
+    "III-6 การดูแลต่อเนื่อง**",
+)
+
+# ตัวเลือกสำหรับ multiselect ("1. I-1.1ก ...") สร้างครั้งเดียวตอน import ไม่ต้องสร้างใหม่ทุก rerun
+SAR_OPTIONS = tuple(f"{i}. {item}" for i, item in enumerate(SAR_ITEMS, start=1))
 
 KNOWLEDGE_BASE = """
 - HA Standard 5th Edition: ...
@@ -177,230 +205,757 @@ KNOWLEDGE_BASE = """
 """
 
 # ===================== Helper: common =====================
-def _limit_df(df, max_rows=MAX_ROWS, max_cols=MAX_COLS):
-    df = df.copy()
-    if df.shape[0] > max_rows:
-        df = df.head(max_rows)
-    if df.shape[1] > max_cols:
-        df = df.iloc[:, :max_cols]
-    return df
+def _write_limited_rows(rows, to_str=str, max_rows=MAX_ROWS, max_cols=MAX_COLS):
+    """
+    เขียนแถว (แถวแรกเป็นหัวตาราง) เป็น CSV text ทีละแถว ตัดที่ max_rows/max_cols
+    หยุดอ่านทันทีเมื่อครบ ไม่ต้องโหลดทั้งตารางเข้าหน่วยความจำ
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    for i, row in enumerate(rows):
+        if i > max_rows:
+            break
+        writer.writerow([to_str(v) for v in row[:max_cols]])
+    return buf.getvalue()
 
 # ===================== Helper: PDF =====================
-def extract_text_from_pdf(file):
-    try:
-        file.seek(0)
-        reader = PdfReader(file)
-        text = ""
-        for page in reader.pages:
-            page_text = page.extract_text()
+_PDFIUM_LOCK = threading.Lock()
+
+def _iter_pdf_pages_pypdf(data):
+    """สำรองด้วย pypdf สำหรับ PDF ที่ PDFium เปิดไม่ได้"""
+    reader = PdfReader(io.BytesIO(data))
+    for page in reader.pages:
+        yield page.extract_text() or ""
+
+def _iter_pdf_pages(data):
+    """คืนข้อความทีละหน้าด้วย PDFium (pypdfium2) ถ้าเปิดไม่ได้จะใช้ pypdf แทน"""
+    # PDFium ไม่ thread-safe (ห้ามเรียกพร้อมกันหลาย thread แม้ต่างเอกสาร) จึงถือ lock ตั้งแต่เปิดจนปิดเอกสาร
+    with _PDFIUM_LOCK:
+        try:
+            pdf = pdfium.PdfDocument(data)
+        except pdfium.PdfiumError:
+            pdf = None
+
+        if pdf is not None:
+            try:
+                for page in pdf:
+                    textpage = page.get_textpage()
+                    page_text = textpage.get_text_range()
+                    # ปิด handle ทันทีเพื่อไม่ให้หน่วยความจำโตตามจำนวนหน้า
+                    textpage.close()
+                    page.close()
+                    yield page_text
+            finally:
+                pdf.close()
+            return
+
+    yield from _iter_pdf_pages_pypdf(data)
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def extract_text_from_pdf(data, max_chars=PDF_MAX_CHARS):
+    """อ่านข้อความทีละหน้า และหยุดทันทีเมื่อเกิน max_chars (หน้าที่เหลือไม่ต้องถอดข้อความ)"""
+    chunks = []
+    used = 0
+    with contextlib.closing(_iter_pdf_pages(data)) as pages:
+        for page_text in pages:
+            if used >= max_chars:
+                chunks.append("[… truncated: remaining pages skipped …]")
+                break
             if page_text:
-                text += page_text + "\n"
-        return text
-    except Exception as e:
-        st.error(f"Error reading PDF file {getattr(file, 'name', '')}: {e}")
-        return ""
+                chunks.append(page_text)
+                used += len(page_text)
+    return "\n".join(chunks)
 
 # ===================== Helper: DOCX =====================
-def extract_text_from_docx(file):
-    try:
-        file.seek(0)
-        data = file.read()
-        doc = Document(io.BytesIO(data))
-        return "\n".join(p.text for p in doc.paragraphs)
-    except Exception as e:
-        st.error(f"Error reading DOCX file {getattr(file, 'name', '')}: {e}")
-        return ""
+@st.cache_data(show_spinner=False, max_entries=32)
+def extract_text_from_docx(data):
+    doc = Document(io.BytesIO(data))
+    return "\n".join(p.text for p in doc.paragraphs)
 
 # ===================== Helper: CSV =====================
-def extract_text_from_csv(file):
-    try:
-        file.seek(0)
-        df = pd.read_csv(file, dtype=str)
-        df = _limit_df(df)
-        return df.to_csv(index=False)
-    except Exception as e:
-        st.error(f"Error reading CSV file {getattr(file, 'name', '')}: {e}")
-        return ""
+@st.cache_data(show_spinner=False, max_entries=32)
+def extract_text_from_csv(data):
+    text_file = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8-sig", newline="")
+    return _write_limited_rows(csv.reader(text_file))
 
 # ===================== Helper: Excel =====================
-def extract_text_from_excel(file):
+def _cell_to_str(value):
+    """แปลงค่าเซลล์จาก calamine เป็นข้อความ (ตัวเลขจำนวนเต็มไม่ต้องมี .0)"""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def _workbook_to_text(wb):
+    """แปลงทุกชีทของ CalamineWorkbook เป็น CSV text"""
+    parts = []
+    for sheet_name in wb.sheet_names:
+        rows = wb.get_sheet_by_name(sheet_name).iter_rows()
+        csv_text = _write_limited_rows(rows, to_str=_cell_to_str)
+        parts.append(f"[Sheet: {sheet_name}]\n{csv_text}\n")
+    return "\n".join(parts)
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def extract_text_from_excel(data):
     """
-    อ่านทุกชีทของ Excel (.xlsx/.xlsm ใช้ openpyxl, .xls ใช้ xlrd)
+    อ่านทุกชีทของ Excel (.xlsx/.xlsm/.xls) ด้วย python-calamine แล้วแปลงเป็น CSV text
+    โดยไม่ผ่าน DataFrame (แถวแรกเป็นหัวตาราง + ข้อมูลไม่เกิน MAX_ROWS แถว)
     """
+    if len(data) > SPOOL_TO_DISK_BYTES:
+        # from_filelike คัดลอกทั้งไฟล์เข้า buffer ของ calamine อีกชุด ไฟล์ใหญ่จึงเขียนลงดิสก์
+        # แล้วเปิดด้วย from_path ให้ calamine อ่านจากไฟล์ทีละส่วนแทน
+        suffix = ".xlsx" if data[:4] == b"PK\x03\x04" else ".xls"
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
+            tmp.write(data)
+        try:
+            return _workbook_to_text(CalamineWorkbook.from_path(tmp.name))
+        finally:
+            os.remove(tmp.name)
+    return _workbook_to_text(CalamineWorkbook.from_filelike(io.BytesIO(data)))
+
+# ===================== Helper: PPTX =====================
+_PPTX_NS = {
+    "a": "http://schemas.openxmlformats.org/drawingml/2006/main",
+    "p": "http://schemas.openxmlformats.org/presentationml/2006/main",
+    "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+    "rel": "http://schemas.openxmlformats.org/package/2006/relationships",
+}
+_A_TBL = f"{{{_PPTX_NS['a']}}}tbl"
+_NOTES_SLIDE_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/notesSlide"
+_XML_PARSER = etree.XMLParser(resolve_entities=False)
+
+# XPath ที่คอมไพล์ไว้ครั้งเดียว: กล่องข้อความ/ตารางตามลำดับในเอกสาร, ข้อความใน run (รวม <a:br/>), และ body ของ notes
+_XP_TEXT_BLOCKS = etree.XPath("//p:txBody | //a:tbl", namespaces=_PPTX_NS)
+_XP_RUN_TEXT = etree.XPath(".//a:t/text() | .//a:br", namespaces=_PPTX_NS)
+_XP_NOTES_BODY = etree.XPath('//p:sp[p:nvSpPr/p:nvPr/p:ph[@type="body"]]/p:txBody', namespaces=_PPTX_NS)
+
+def _read_xml_part(z, part_name):
+    return etree.fromstring(z.read(part_name), _XML_PARSER)
+
+def _read_rels(z, part_name):
+    """คืน dict rId -> (relationship type, ชื่อ part ปลายทาง) ของ part ที่กำหนด"""
+    folder, _, base = part_name.rpartition("/")
     try:
-        file.seek(0)
-        ext = Path(getattr(file, "name", "")).suffix.lower()
-        if ext in [".xlsx", ".xlsm"]:
-            engine = "openpyxl"
-        elif ext == ".xls":
-            engine = "xlrd"
-        else:
-            engine = None  # เผื่อกรณีพิเศษ
+        root = _read_xml_part(z, f"{folder}/_rels/{base}.rels")
+    except KeyError:
+        return {}
+    return {
+        rel.get("Id"): (rel.get("Type"), posixpath.normpath(posixpath.join(folder, rel.get("Target"))))
+        for rel in root.iterfind("rel:Relationship", _PPTX_NS)
+    }
 
-        xls = pd.ExcelFile(file, engine=engine) if engine else pd.ExcelFile(file)
-        parts = []
-        for sheet_name in xls.sheet_names:
-            df = xls.parse(sheet_name=sheet_name, dtype=str)
-            df = _limit_df(df)
-            csv_text = df.to_csv(index=False)
-            parts.append(f"[Sheet: {sheet_name}]\n{csv_text}\n")
-        return "\n".join(parts)
+def _paragraph_to_str(para):
+    # <a:br/> (Shift+Enter) เป็น "\v" เหมือน python-pptx ไม่เช่นนั้นคำสองบรรทัดจะติดกัน
+    return "".join(node if isinstance(node, str) else "\v" for node in _XP_RUN_TEXT(para))
 
-    except ImportError as ie:
-        st.error("ขาดไลบรารีอ่าน Excel:\n• .xlsx/.xlsm ต้องมี openpyxl\n• .xls ต้องมี xlrd")
-        st.exception(ie)
-        return ""
-    except Exception as e:
-        st.error(f"Error reading Excel file {getattr(file, 'name', '')}: {e}")
-        return ""
+def _text_body_to_str(body):
+    return "\n".join(_paragraph_to_str(para) for para in body.iterfind("a:p", _PPTX_NS)).strip()
 
-# ===================== Helper: PPTX =====================
-def _extract_text_from_table(tbl):
+def _xml_table_to_str(tbl):
+    r"""แปลง <a:tbl> เป็นข้อความ แถวละบรรทัด เซลล์คั่นด้วย ","
+
+    ข้อความในเซลล์ได้เท่ากับ cell.text.strip() ของ python-pptx (ย่อหน้าคั่นด้วย "\n", <a:br/> เป็น "\v")
+    """
     rows = []
-    for r in tbl.rows:
-        rows.append(",".join(c.text.strip() for c in r.cells))
+    for tr in tbl.iterfind("a:tr", _PPTX_NS):
+        cells = []
+        for tc in tr.iterfind("a:tc", _PPTX_NS):
+            body = tc.find("a:txBody", _PPTX_NS)
+            cells.append(_text_body_to_str(body) if body is not None else "")
+        rows.append(",".join(cells))
     return "\n".join(rows)
 
-def _walk_shapes(shapes, out_parts):
-    for sh in shapes:
+def _walk_shapes(root_shapes, out_parts):
+    """ไล่ทุก shape แบบใช้ stack แทน recursion (group ซ้อนลึกแค่ไหนก็ไม่ชน RecursionError)"""
+    # ใส่กลับด้านเพื่อให้ pop() ได้ shape ตามลำดับเดิมในสไลด์
+    stack = deque(reversed(list(root_shapes)))
+    while stack:
+        sh = stack.pop()
         # text box / placeholder
-        if hasattr(sh, "has_text_frame") and sh.has_text_frame:
-            txt = sh.text_frame.text or ""
-            if txt.strip():
-                out_parts.append(txt.strip())
+        if getattr(sh, "has_text_frame", False):
+            txt = (sh.text_frame.text or "").strip()
+            if txt:
+                out_parts.append(txt)
         # table
-        if hasattr(sh, "has_table") and sh.has_table:
-            out_parts.append(_extract_text_from_table(sh.table))
+        if getattr(sh, "has_table", False):
+            # อ่านเซลล์จาก XML ของตารางด้วย XPath ครั้งเดียว แทนการเรียก cell.text ทีละเซลล์
+            out_parts.append(_xml_table_to_str(sh.table._tbl))
         # group
-        if hasattr(sh, "shapes"):
-            _walk_shapes(sh.shapes, out_parts)
+        children = getattr(sh, "shapes", None)
+        if children is not None:
+            stack.extend(reversed(list(children)))
+
+def _extract_text_from_pptx_model(data):
+    """อ่าน PPTX ผ่าน object model ของ python-pptx (ใช้สำรองเมื่ออ่าน XML ตรงไม่ได้)"""
+    prs = Presentation(io.BytesIO(data))
+    # สะสมทุกบรรทัดใน list เดียว แล้ว join ครั้งเดียวตอนท้าย ("" คั่นสไลด์ = บรรทัดว่าง)
+    parts = []
+    for i, slide in enumerate(prs.slides, start=1):
+        if parts:
+            parts.append("")
+        parts.append(f"[Slide {i}]")
+        _walk_shapes(slide.shapes, parts)
+        # notes
+        if slide.has_notes_slide and slide.notes_slide.notes_text_frame:
+            note = slide.notes_slide.notes_text_frame.text or ""
+            if note.strip():
+                parts.append(f"[Notes]\n{note.strip()}")
+    return "\n".join(parts)
+
+def _extract_text_from_pptx_xml(data):
+    """อ่านข้อความจาก XML ของแต่ละสไลด์ใน ZIP โดยตรง ไม่ต้องสร้าง object model ทั้งไฟล์"""
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        pres_part = "ppt/presentation.xml"
+        pres_rels = _read_rels(z, pres_part)
+        slide_ids = _read_xml_part(z, pres_part).iterfind("p:sldIdLst/p:sldId", _PPTX_NS)
+        slide_parts = [pres_rels[sld.get(f"{{{_PPTX_NS['r']}}}id")][1] for sld in slide_ids]
 
-def extract_text_from_pptx(file):
-    """อ่านข้อความทุกสไลด์ รวม group/table และ notes"""
-    try:
-        file.seek(0)
-        data = file.read()
-        prs = Presentation(io.BytesIO(data))
         parts = []
-        for i, slide in enumerate(prs.slides, start=1):
-            slide_parts = [f"[Slide {i}]"]
-            _walk_shapes(slide.shapes, slide_parts)
+        for i, slide_part in enumerate(slide_parts, start=1):
+            if parts:
+                parts.append("")
+            parts.append(f"[Slide {i}]")
+            for el in _XP_TEXT_BLOCKS(_read_xml_part(z, slide_part)):
+                if el.tag == _A_TBL:
+                    parts.append(_xml_table_to_str(el))
+                else:
+                    txt = _text_body_to_str(el)
+                    if txt:
+                        parts.append(txt)
             # notes
-            if slide.has_notes_slide and slide.notes_slide.notes_text_frame:
-                note = slide.notes_slide.notes_text_frame.text or ""
-                if note.strip():
-                    slide_parts.append(f"[Notes]\n{note.strip()}")
-            parts.append("\n".join(slide_parts))
-        return "\n\n".join(parts)
-    except Exception as e:
-        st.error(f"Error reading PPTX file {getattr(file, 'name', '')}: {e}")
-        return ""
+            for rel_type, target in _read_rels(z, slide_part).values():
+                if rel_type == _NOTES_SLIDE_REL:
+                    bodies = _XP_NOTES_BODY(_read_xml_part(z, target))
+                    note = _text_body_to_str(bodies[0]) if bodies else ""
+                    if note:
+                        parts.append(f"[Notes]\n{note}")
+        return "\n".join(parts)
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def extract_text_from_pptx(data):
+    """อ่านข้อความทุกสไลด์ รวม group/table และ notes"""
+    try:
+        return _extract_text_from_pptx_xml(data)
+    except (etree.XMLSyntaxError, KeyError):
+        return _extract_text_from_pptx_model(data)
 
 # ===================== Aggregate all input =====================
-def get_all_input_text(uploaded_files, additional_context):
-    full_text = ""
+# ชนิดไฟล์ (จาก _sniff_file_type) -> (ชื่อที่ใช้ในข้อความ error, ฟังก์ชันอ่าน)
+_EXTRACTORS = {
+    "pdf": ("PDF", extract_text_from_pdf),
+    "docx": ("DOCX", extract_text_from_docx),
+    "excel": ("Excel", extract_text_from_excel),
+    "pptx": ("PPTX", extract_text_from_pptx),
+    "csv": ("CSV", extract_text_from_csv),
+}
+
+# โฟลเดอร์ภายใน ZIP ที่บอกชนิดของไฟล์ Office (OOXML)
+_OOXML_PREFIXES = (("word/", "docx"), ("xl/", "excel"), ("ppt/", "pptx"))
+
+def _sniff_file_type(data, name=""):
+    """
+    ระบุชนิดไฟล์จาก magic bytes แทนชื่อไฟล์/MIME (ไฟล์ที่ตั้งนามสกุลผิดก็อ่านได้)
+    ใช้ชื่อไฟล์เฉพาะกรณีที่ magic bytes ไม่พอ (OLE2 ใช้ทั้ง .xls/.doc/.ppt)
+    คืน key ของ _EXTRACTORS หรือ None ถ้าไม่รองรับ
+    """
+    head = data[:4]
+    if head == b"PK\x03\x04":
+        try:
+            with zipfile.ZipFile(io.BytesIO(data)) as z:
+                names = z.namelist()
+        except zipfile.BadZipFile:
+            return None
+        for prefix, kind in _OOXML_PREFIXES:
+            if any(n.startswith(prefix) for n in names):
+                return kind
+        return None
+    if head == b"\xd0\xcf\x11\xe0":
+        # OLE2 compound file: อ่านได้เฉพาะ .xls รุ่นเก่า (.doc/.ppt รุ่นเก่าไม่รองรับ)
+        return "excel" if name.lower().endswith(".xls") else None
+    # PDF อนุญาตให้มีข้อมูลนำหน้า header ได้ภายใน 1024 ไบต์แรก
+    if b"%PDF-" in data[:1024]:
+        return "pdf"
+    # ที่เหลือถือเป็น CSV เมื่อเป็นข้อความ UTF-8 เท่านั้น (ตรวจแค่ช่วงต้นไฟล์ final=False ยอมให้ตัดกลางตัวอักษร)
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(data[:65536], final=False)
+    except UnicodeDecodeError:
+        return None
+    return "csv"
+
+def _extract_one(file):
+    """
+    อ่านไฟล์เดียว (รันใน worker thread) คืน (ชื่อไฟล์, ข้อความ, ข้อความแจ้งเตือน)
+    ข้อความแจ้งเตือนเก็บไว้ให้ main thread แสดง เพราะเรียก st.* ได้จาก script thread เท่านั้น
+    ผลการอ่านถูก cache ตามเนื้อหาไฟล์ กดสร้างรายงานซ้ำด้วยไฟล์เดิมจึงไม่ต้องอ่านใหม่
+    """
+    messages = []
+    # getvalue() คืน bytes ชุดเดียวกับที่ Streamlit เก็บไว้ (ไม่คัดลอก) และ extractor ห่อด้วย BytesIO
+    # ซึ่งใช้ buffer ร่วมกัน เนื้อหาไฟล์จึงมีชุดเดียวในหน่วยความจำ และใช้เป็น cache key ของ st.cache_data
+    data = file.getvalue()
+
+    kind = _sniff_file_type(data, file.name)
+    if kind is None:
+        messages.append(("warning", f"Unsupported file type: {file.name}. Skipping."))
+        return file.name, "", messages
+
+    label, extractor = _EXTRACTORS[kind]
+    try:
+        text = extractor(data)
+    except Exception as e:
+        messages.append(("error", f"Error reading {label} file {file.name}: {e}"))
+        text = ""
+    return file.name, text, messages
+
+def _fit_to_token_budget(api_key, texts, max_tokens=MAX_CONTEXT_TOKENS):
+    """
+    ตัดข้อความของแต่ละไฟล์ตามสัดส่วนขนาดไฟล์ ให้รวมกันไม่เกิน max_tokens (นับด้วย Gemini count_tokens)
+    """
+    # จำนวน token ไม่เกินจำนวนไบต์ UTF-8 ถ้าไบต์รวมยังไม่เกินงบก็ไม่ต้องเรียก API นับ
+    if sum(len(t.encode("utf-8")) for t in texts) <= max_tokens:
+        return texts
+
+    try:
+        client = _get_genai_client(api_key)
+        total_tokens = client.models.count_tokens(
+            model="gemini-2.5-flash",
+            contents="".join(texts)
+        ).total_tokens
+    except Exception as e:
+        st.warning(f"นับจำนวน token ไม่สำเร็จ จะส่งข้อมูลทั้งหมดโดยไม่ตัด: {e}")
+        return texts
+
+    if total_tokens <= max_tokens:
+        return texts
+
+    ratio = max_tokens / total_tokens
+    fitted = []
+    for text in texts:
+        keep = int(len(text) * ratio)
+        if keep < len(text):
+            text = f"{text[:keep]}\n[… truncated {len(text) - keep} chars …]"
+        fitted.append(text)
+    st.warning(f"ข้อมูลจากไฟล์ยาวเกิน {max_tokens:,} tokens ({total_tokens:,}) จึงตัดเนื้อหาแต่ละไฟล์ตามสัดส่วน")
+    return fitted
+
+def get_all_input_text(uploaded_files, additional_context, api_key):
+    parts = []
     if not uploaded_files and not additional_context:
         return "", False
 
     if uploaded_files:
-        for file in uploaded_files:
-            full_text += f"--- START OF FILE: {file.name} ---\n\n"
-            name = (file.name or "").lower()
-            mime = (file.type or "").lower()
+        # อ่านหลายไฟล์พร้อมกัน แล้วเรียงผลกลับตามลำดับที่อัปโหลด
+        results = [None] * len(uploaded_files)
+        with ThreadPoolExecutor(max_workers=min(8, len(uploaded_files))) as pool:
+            futures = {pool.submit(_extract_one, file): i for i, file in enumerate(uploaded_files)}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
 
-            try:
-                if name.endswith(".pdf") or "pdf" in mime:
-                    full_text += extract_text_from_pdf(file)
+        for _, _, messages in results:
+            for level, msg in messages:
+                getattr(st, level)(msg)
 
-                elif name.endswith(".docx") or "wordprocessingml" in mime:
-                    full_text += extract_text_from_docx(file)
+        texts = _fit_to_token_budget(api_key, [text for _, text, _ in results])
 
-                elif name.endswith((".xlsx", ".xlsm")) or "officedocument.spreadsheetml" in mime:
-                    full_text += extract_text_from_excel(file)
+        for (file_name, _, _), text in zip(results, texts):
+            parts.append(f"--- START OF FILE: {file_name} ---\n\n")
+            parts.append(text)
+            parts.append(f"\n\n--- END OF FILE: {file_name} ---\n\n")
 
-                elif name.endswith(".xls") or mime == "application/vnd.ms-excel":
-                    full_text += extract_text_from_excel(file)
+    if additional_context:
+        parts.append(f"--- START OF ADDITIONAL USER NOTES ---\n\n{additional_context}\n\n--- END OF ADDITIONAL USER NOTES ---\n\n")
 
-                elif name.endswith(".csv") or "text/csv" in mime:
-                    full_text += extract_text_from_csv(file)
+    return "".join(parts), True
 
-                elif name.endswith(".pptx") or "officedocument.presentationml.presentation" in mime:
-                    full_text += extract_text_from_pptx(file)
+# ===================== Gemini call =====================
+# prompt แบ่งเป็น 3 ส่วน: ภารกิจ + (ฐานความรู้/ข้อมูลนำเข้า) + คำสั่ง เพื่อให้ส่วนกลางย้ายไปไว้ใน context cache ได้
+_PROMPT_ROLE = textwrap.dedent("""\
+    คุณคือผู้เชี่ยวชาญด้านการรับรองคุณภาพโรงพยาบาลในประเทศไทย (Hospital Accreditation) ที่มีความสามารถในการเขียนรายงานประเมินตนเอง (Self-Assessment Report - SAR) ตามมาตรฐาน HA ฉบับที่ 5
 
-                else:
-                    st.warning(f"Unsupported file type: {file.name}. Skipping.")
-            except Exception as e:
-                st.error(f"Error reading file {file.name}: {e}")
+    """)
 
-            full_text += f"\n\n--- END OF FILE: {file.name} ---\n\n"
+_PROMPT_HEAD = _PROMPT_ROLE + textwrap.dedent("""\
+    **ภารกิจของคุณ:**
+    เขียนรายงาน SAR สำหรับหัวข้อต่อไปนี้:
+    **{sar_item}**
 
-    if additional_context:
-        full_text += f"--- START OF ADDITIONAL USER NOTES ---\n\n{additional_context}\n\n--- END OF ADDITIONAL USER NOTES ---\n\n"
+    """)
 
-    return full_text, True
+_PROMPT_CONTEXT = textwrap.dedent("""\
+    **ฐานความรู้ของคุณ:**
+    {knowledge_base}
 
-# ===================== Gemini call =====================
-def generate_sar_section(api_key, sar_item, context_data):
-    """Generates a single SAR section using the Gemini API (Google GenAI SDK)."""
-    try:
-        client = genai.Client(api_key=api_key)
+    **ข้อมูลนำเข้า (จากไฟล์และข้อความที่ผู้ใช้อัปโหลด):**
+    ```
+    {context_data}
+    ```
+    """)
 
-        prompt_tmpl = Template(textwrap.dedent("""\
-            คุณคือผู้เชี่ยวชาญด้านการรับรองคุณภาพโรงพยาบาลในประเทศไทย (Hospital Accreditation) ที่มีความสามารถในการเขียนรายงานประเมินตนเอง (Self-Assessment Report - SAR) ตามมาตรฐาน HA ฉบับที่ 5
-
-            **ภารกิจของคุณ:**
-            เขียนรายงาน SAR สำหรับหัวข้อต่อไปนี้:
-            **${sar_item}**
-
-            **ฐานความรู้ของคุณ:**
-            ${knowledge_base}
-
-            **ข้อมูลนำเข้า (จากไฟล์และข้อความที่ผู้ใช้อัปโหลด):**
-            ```
-            ${context_data}
-            ```
-            **คำสั่งหลัก (Rule-Based Process):**
-
-            **ขั้นตอนที่ 1: การวิเคราะห์ความเกี่ยวข้อง (Relevance Analysis)**
-            เปรียบเทียบเนื้อหาใน "ข้อมูลนำเข้า" กับหัวข้อ **"${sar_item}"** แล้วตัดสินใจว่าพอเพียงหรือไม่
-
-            **ขั้นตอนที่ 2: ดำเนินการตามผลการวิเคราะห์**
-
-            **กรณีที่ 1: ข้อมูลเพียงพอ**
-            เขียนรายงาน 4 ส่วน: (i) บริบท, (ii) ประเด็น/แผนการพัฒนา, (iii) ผลที่โดดเด่น, (iv) ผลลัพธ์
-            - (i) บริบท: สรุปภาพรวม/นโยบาย/สถานการณ์ที่เกี่ยวข้อง อ้างอิงจากข้อมูลที่ได้รับ
-            - (ii) ประเด็น/แผน:
-              1) ฉบับเต็ม: ทุกย่อหน้าเริ่มด้วย "เพื่อ..." และเล่าตามลำดับ วัตถุประสงค์→ทำอะไร→ผลเปลี่ยนแปลง→ช่องว่าง
-              2) ฉบับสรุป ≤400 ตัวอักษร หัวข้อ "**ii (สรุป ≤400 ตัวอักษร – ทางเลือก):**"
-            - (iii) โดดเด่น: 1–2 ประโยคสั้นๆ เน้นใจความสำคัญเท่านั้น
-            - (iv) ผลลัพธ์: สรุปเชิงคุณภาพ/เชิงปริมาณ ปิดด้วยหมายเหตุเรื่อง KPI ย้อนหลัง 3–5 ปีให้ผู้ใช้วิเคราะห์เอง
-
-            **กรณีที่ 2: ข้อมูลไม่เพียงพอ**
-            ตอบกลับข้อความนี้เท่านั้น:
-            "**[AI Analysis]:** จากการตรวจสอบไฟล์และข้อมูลที่ท่านให้มา ไม่พบเนื้อหาที่เกี่ยวข้องโดยตรงกับหัวข้อ **'${sar_item}'** ครับ/ค่ะ กรุณาอัปโหลดเอกสารที่ตรงกับหัวข้อที่เลือก เพื่อให้ AI สามารถสร้างรายงานได้อย่างถูกต้อง"
-
-            **ข้อบังคับเพิ่มเติม**
-            - อ้างอิงเฉพาะข้อมูลนำเข้าที่ให้มา
-            - ระบุชื่อไฟล์/ชีท/สไลด์/หน้า เมื่ออ้างอิง
-            """))
-
-        prompt = prompt_tmpl.substitute(
-            sar_item=sar_item,
-            knowledge_base=KNOWLEDGE_BASE,
-            context_data=context_data
-        )
+# ใช้แทน _PROMPT_CONTEXT เมื่อฐานความรู้และข้อมูลนำเข้าอยู่ใน cached content แล้ว
+_PROMPT_CONTEXT_REF = textwrap.dedent("""\
+    **ฐานความรู้และข้อมูลนำเข้า:** อยู่ในเนื้อหาที่แนบไว้ก่อนหน้านี้ (ฐานความรู้ของคุณ และข้อมูลนำเข้าจากไฟล์และข้อความที่ผู้ใช้อัปโหลด)
+
+    """)
+
+# โครงสร้างรายงาน (กรณีข้อมูลเพียงพอ) ใช้ร่วมกันทั้งแบบหัวข้อเดียวและหลายหัวข้อ
+_REPORT_STRUCTURE = textwrap.dedent("""\
+    เขียนรายงาน 4 ส่วน: (i) บริบท, (ii) ประเด็น/แผนการพัฒนา, (iii) ผลที่โดดเด่น, (iv) ผลลัพธ์
+    - (i) บริบท: สรุปภาพรวม/นโยบาย/สถานการณ์ที่เกี่ยวข้อง อ้างอิงจากข้อมูลที่ได้รับ
+    - (ii) ประเด็น/แผน:
+      1) ฉบับเต็ม: ทุกย่อหน้าเริ่มด้วย "เพื่อ..." และเล่าตามลำดับ วัตถุประสงค์→ทำอะไร→ผลเปลี่ยนแปลง→ช่องว่าง
+      2) ฉบับสรุป ≤400 ตัวอักษร หัวข้อ "**ii (สรุป ≤400 ตัวอักษร – ทางเลือก):**"
+    - (iii) โดดเด่น: 1–2 ประโยคสั้นๆ เน้นใจความสำคัญเท่านั้น
+    - (iv) ผลลัพธ์: สรุปเชิงคุณภาพ/เชิงปริมาณ ปิดด้วยหมายเหตุเรื่อง KPI ย้อนหลัง 3–5 ปีให้ผู้ใช้วิเคราะห์เอง
+    """)
+
+_PROMPT_RULES = textwrap.dedent("""\
+    **คำสั่งหลัก (Rule-Based Process):**
+
+    **ขั้นตอนที่ 1: การวิเคราะห์ความเกี่ยวข้อง (Relevance Analysis)**
+    เปรียบเทียบเนื้อหาใน "ข้อมูลนำเข้า" กับหัวข้อ **"{sar_item}"** แล้วตัดสินใจว่าพอเพียงหรือไม่
+
+    **ขั้นตอนที่ 2: ดำเนินการตามผลการวิเคราะห์**
+
+    **กรณีที่ 1: ข้อมูลเพียงพอ**
+    """) + _REPORT_STRUCTURE + textwrap.dedent("""\
+
+    **กรณีที่ 2: ข้อมูลไม่เพียงพอ**
+    ตอบกลับข้อความนี้เท่านั้น:
+    "**[AI Analysis]:** จากการตรวจสอบไฟล์และข้อมูลที่ท่านให้มา ไม่พบเนื้อหาที่เกี่ยวข้องโดยตรงกับหัวข้อ **'{sar_item}'** ครับ/ค่ะ กรุณาอัปโหลดเอกสารที่ตรงกับหัวข้อที่เลือก เพื่อให้ AI สามารถสร้างรายงานได้อย่างถูกต้อง"
 
-        resp = client.models.generate_content(
+    **ข้อบังคับเพิ่มเติม**
+    - อ้างอิงเฉพาะข้อมูลนำเข้าที่ให้มา
+    - ระบุชื่อไฟล์/ชีท/สไลด์/หน้า เมื่ออ้างอิง
+    """)
+
+# prompt แบบหลายหัวข้อในการเรียกครั้งเดียว: ทุกหัวข้อได้คำตอบของตัวเองใน JSON (รวมถึงกรณีข้อมูลไม่เพียงพอ)
+_BATCH_PROMPT_HEAD = _PROMPT_ROLE + textwrap.dedent("""\
+    **ภารกิจของคุณ:**
+    เขียนรายงาน SAR แยกทีละหัวข้อ สำหรับทุกหัวข้อในรายการต่อไปนี้:
+    {item_list}
+
+    """)
+
+_BATCH_PROMPT_RULES = textwrap.dedent("""\
+    **คำสั่งหลัก (Rule-Based Process) — ทำแยกทีละหัวข้อ:**
+
+    **ขั้นตอนที่ 1: การวิเคราะห์ความเกี่ยวข้อง (Relevance Analysis)**
+    สำหรับแต่ละหัวข้อ เปรียบเทียบเนื้อหาใน "ข้อมูลนำเข้า" กับหัวข้อนั้น แล้วตัดสินใจว่าพอเพียงหรือไม่
+
+    **ขั้นตอนที่ 2: ดำเนินการตามผลการวิเคราะห์ของหัวข้อนั้น**
+
+    **กรณีที่ 1: ข้อมูลเพียงพอ**
+    """) + _REPORT_STRUCTURE + textwrap.dedent("""\
+
+    **กรณีที่ 2: ข้อมูลไม่เพียงพอ**
+    ใช้ข้อความนี้เป็นรายงานของหัวข้อนั้น โดยแทน <ชื่อหัวข้อ> ด้วยชื่อหัวข้อนั้น (หัวข้ออื่นยังเขียนตามปกติ):
+    "**[AI Analysis]:** จากการตรวจสอบไฟล์และข้อมูลที่ท่านให้มา ไม่พบเนื้อหาที่เกี่ยวข้องโดยตรงกับหัวข้อ **'<ชื่อหัวข้อ>'** ครับ/ค่ะ กรุณาอัปโหลดเอกสารที่ตรงกับหัวข้อที่เลือก เพื่อให้ AI สามารถสร้างรายงานได้อย่างถูกต้อง"
+
+    **ข้อบังคับเพิ่มเติม**
+    - อ้างอิงเฉพาะข้อมูลนำเข้าที่ให้มา
+    - ระบุชื่อไฟล์/ชีท/สไลด์/หน้า เมื่ออ้างอิง
+
+    **รูปแบบคำตอบ:**
+    ตอบกลับเป็น JSON ในรูปแบบ {"sections": [{"item": "<ชื่อหัวข้อตรงตามรายการทุกตัวอักษร>", "report": "<รายงาน SAR (Markdown) ของหัวข้อนั้น>"}]}
+    เรียงตามลำดับรายการและครบทุกหัวข้อ
+    """)
+
+_BATCH_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "sections": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "item": {"type": "STRING"},
+                    "report": {"type": "STRING"},
+                },
+                "required": ["item", "report"],
+            },
+        },
+    },
+    "required": ["sections"],
+}
+
+@st.cache_resource(show_spinner=False)
+def _get_genai_client(api_key):
+    """สร้าง genai.Client ครั้งเดียวต่อ API key แล้วใช้ซ้ำทุก rerun/ทุกการเรียก"""
+    return genai.Client(api_key=api_key)
+
+def _get_context_cache(api_key, context_data, create=True):
+    """
+    ฝากฐานความรู้ + ข้อมูลนำเข้าไว้กับ Gemini context caching เพื่อไม่ต้องส่ง token ชุดเดิมซ้ำทุกการเรียก
+    ใช้ cache เดิมใน st.session_state ถ้าข้อมูลเหมือนเดิมและยังไม่หมดอายุ
+    create=False (หัวข้อเดียว): ไม่รอสร้าง cache กับข้อมูลชุดใหม่ จะสร้างเมื่อสั่งสร้างซ้ำด้วยข้อมูลชุดเดิมเท่านั้น
+    คืนชื่อ cached content หรือ None (ข้อมูลสั้นเกินไป/สร้างไม่สำเร็จ ให้ส่ง prompt เต็มแทน)
+    """
+    context_block = _build_context_block(context_data)
+    if len(context_block) < CONTEXT_CACHE_MIN_CHARS:
+        return None
+
+    key = hashlib.sha256(context_block.encode("utf-8")).hexdigest()
+    cached = st.session_state.get("context_cache")
+    # เผื่อเวลา 5 นาทีก่อนหมดอายุจริง
+    expires_at = time.time() + CONTEXT_CACHE_TTL_SECONDS - 300
+    if cached and cached["key"] == key and cached["expires_at"] > time.time():
+        if cached["name"] or cached["tried"]:
+            return cached["name"]
+        # เคยเห็นข้อมูลชุดนี้แล้ว (สร้างซ้ำ) จึงคุ้มที่จะสร้าง cache
+    elif not create:
+        _set_context_cache(api_key, {"key": key, "name": None, "tried": False, "expires_at": expires_at})
+        return None
+
+    try:
+        client = _get_genai_client(api_key)
+        cache = client.caches.create(
             model="gemini-2.5-flash",
-            contents=prompt
+            config={"contents": [context_block], "ttl": f"{CONTEXT_CACHE_TTL_SECONDS}s"}
         )
-        return getattr(resp, "text", None) or getattr(resp, "output_text", None)
+        name = cache.name
+    except Exception:
+        # เช่น ยังไม่ถึงจำนวน token ขั้นต่ำของ context caching — จำผลไว้ จะได้ไม่ลองสร้างซ้ำทุกครั้ง
+        name = None
+    _set_context_cache(api_key, {"key": key, "name": name, "tried": True, "expires_at": expires_at})
+    return name
+
+def _set_context_cache(api_key, entry):
+    """บันทึก cache ชุดใหม่ลง st.session_state และลบ cache เดิมบน Gemini (ไม่ต้องรอให้หมดอายุและเสียค่าเก็บ)"""
+    old = st.session_state.get("context_cache")
+    if old and old["name"] and old["name"] != entry["name"]:
+        try:
+            _get_genai_client(api_key).caches.delete(name=old["name"])
+        except Exception:
+            # หมดอายุ/ถูกลบไปแล้ว — ไม่เป็นไร
+            pass
+    st.session_state.context_cache = entry
+
+def _build_context_block(context_data):
+    """ส่วนฐานความรู้ + ข้อมูลนำเข้าของ prompt (ส่วนที่เหมือนกันทุกหัวข้อ)"""
+    return _PROMPT_CONTEXT.format(knowledge_base=KNOWLEDGE_BASE, context_data=context_data)
+
+def _build_prompt(sar_item, context_data):
+    """
+    ประกอบ prompt สำหรับเขียน SAR ของหัวข้อที่กำหนด
+    context_data=None หมายถึงฐานความรู้และข้อมูลนำเข้าอยู่ใน cached content แล้ว
+    """
+    context_block = _PROMPT_CONTEXT_REF if context_data is None else _build_context_block(context_data)
+    return _PROMPT_HEAD.format(sar_item=sar_item) + context_block + _PROMPT_RULES.format(sar_item=sar_item)
+
+def generate_sar_section(api_key, sar_item, context_data, placeholder=None):
+    """
+    Generates a single SAR section using the Gemini API (Google GenAI SDK).
+    Streams the output; if a placeholder (st.empty()) is given, the partial report is rendered as it arrives.
+    """
+    try:
+        client = _get_genai_client(api_key)
+
+        # หัวข้อเดียวเรียกครั้งเดียว: ไม่รอ caches.create ก่อนเริ่ม stream ถ้าเป็นข้อมูลชุดใหม่
+        cache_name = _get_context_cache(api_key, context_data, create=False)
+        if cache_name:
+            prompt = _build_prompt(sar_item, None)
+            config = {"cached_content": cache_name}
+        else:
+            prompt = _build_prompt(sar_item, context_data)
+            config = None
+
+        report = ""
+        for chunk in client.models.generate_content_stream(
+            model="gemini-2.5-flash",
+            contents=prompt,
+            config=config
+        ):
+            if not chunk.text:
+                continue
+            report += chunk.text
+            if placeholder is not None:
+                placeholder.markdown(report)
+        return report or None
 
     except Exception as e:
         st.error(f"An error occurred while calling the Gemini API: {e}")
         st.error("เคล็ดลับ: ตรวจสอบ API Key/สิทธิ์ และชื่อโมเดลว่ารองรับ generateContent")
         return None
 
+def _build_batch_prompt(sar_items, context_data):
+    """
+    ประกอบ prompt สำหรับเขียนหลายหัวข้อในการเรียกครั้งเดียว โดยให้ตอบกลับเป็น JSON
+    context_data=None หมายถึงฐานความรู้และข้อมูลนำเข้าอยู่ใน cached content แล้ว
+    """
+    # ตัวเลือกขึ้นต้นด้วยหมายเลขหัวข้ออยู่แล้ว ("1. I-1.1ก ...") จึงไม่ใส่ลำดับซ้ำ ให้ชื่อตรงกับที่ใช้จับคู่คำตอบ
+    item_list = "\n".join(sar_items)
+    context_block = _PROMPT_CONTEXT_REF if context_data is None else _build_context_block(context_data)
+    return _BATCH_PROMPT_HEAD.format(item_list=item_list) + context_block + _BATCH_PROMPT_RULES
+
+def _parse_batch_response(text, sar_items):
+    """แปลง JSON จาก Gemini เป็น list รายงานเรียงตาม sar_items (หัวข้อที่ไม่มีคำตอบเป็น None)"""
+    sections = orjson.loads(text).get("sections", [])
+    by_item = {sec.get("item"): sec.get("report") for sec in sections}
+    # โมเดลอาจเขียนชื่อหัวข้อไม่ตรงตัว คำตอบที่จับคู่ด้วยชื่อไม่ได้ให้ใช้ตามลำดับกับหัวข้อที่ยังไม่มีคำตอบ
+    unmatched = iter([sec.get("report") for sec in sections if sec.get("item") not in sar_items])
+    reports = []
+    for item in sar_items:
+        report = by_item.get(item) if item in by_item else next(unmatched, None)
+        reports.append(report or None)
+    return reports
+
+async def _generate_batch_async(client, sem, sar_items, context_data, config):
+    """เรียก Gemini (async) หนึ่งครั้งสำหรับหัวข้อชุดหนึ่ง โดยจำกัดจำนวนที่รันพร้อมกันด้วย semaphore"""
+    async with sem:
+        try:
+            resp = await client.aio.models.generate_content(
+                model="gemini-2.5-flash",
+                contents=_build_batch_prompt(sar_items, context_data),
+                config=config
+            )
+            return _parse_batch_response(resp.text, sar_items)
+        except Exception as e:
+            st.error(f"An error occurred while calling the Gemini API: {e}")
+            return [None] * len(sar_items)
+
+def generate_sar_sections(api_key, sar_items, context_data):
+    """
+    สร้าง SAR หลายหัวข้อ โดยรวมครั้งละไม่เกิน MAX_ITEMS_PER_CALL หัวข้อต่อการเรียก Gemini หนึ่งครั้ง
+    และยิงทุกชุดพร้อมกัน (ไม่เกิน MAX_CONCURRENT_CALLS) ผ่าน client เดียวกัน
+    คืน list รายงานเรียงตาม sar_items (หัวข้อที่สร้างไม่สำเร็จเป็น None)
+    """
+    try:
+        # client ของงาน async สร้างใหม่ต่อรอบ เพราะ HTTP session ฝั่ง async ผูกกับ event loop
+        # ที่ asyncio.run ปิดไปหลังจบแต่ละรอบ จึงใช้ client ที่ cache ไว้ร่วมกันข้ามรอบไม่ได้
+        client = genai.Client(api_key=api_key)
+    except Exception as e:
+        st.error(f"An error occurred while calling the Gemini API: {e}")
+        return [None] * len(sar_items)
+
+    batches = [
+        sar_items[start:start + MAX_ITEMS_PER_CALL]
+        for start in range(0, len(sar_items), MAX_ITEMS_PER_CALL)
+    ]
+
+    # ข้อมูลนำเข้าเหมือนกันทุกชุด ฝากไว้ใน context cache ครั้งเดียวแล้วให้ทุกชุดอ้างถึง
+    config = {"response_mime_type": "application/json", "response_schema": _BATCH_RESPONSE_SCHEMA}
+    cache_name = _get_context_cache(api_key, context_data)
+    if cache_name:
+        config["cached_content"] = cache_name
+        context_data = None
+
+    async def run_all():
+        sem = asyncio.Semaphore(MAX_CONCURRENT_CALLS)
+        return await asyncio.gather(
+            *(_generate_batch_async(client, sem, batch, context_data, config) for batch in batches)
+        )
+
+    results = asyncio.run(run_all())
+    return [report for batch_reports in results for report in batch_reports]
+
+def _format_reports(sar_items, reports):
+    """รวมรายงานหลายหัวข้อเป็น Markdown เดียว (หัวข้อเดียวคืนรายงานตรงๆ) หรือ None ถ้าไม่สำเร็จเลย"""
+    if not any(reports):
+        return None
+    if len(sar_items) == 1:
+        return reports[0]
+    return "\n\n---\n\n".join(
+        f"## {item}\n\n{report or 'ไม่สามารถสร้างรายงานหัวข้อนี้ได้'}"
+        for item, report in zip(sar_items, reports)
+    )
+
+# ===================== Gemini Batch Mode =====================
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+def submit_sar_batch_job(api_key, sar_items, context_data):
+    """
+    ส่งทุกหัวข้อเป็น inline batch job ของ Gemini (ราคาถูกกว่า แต่รอผลระดับนาที)
+    หนึ่ง request ต่อหนึ่งหัวข้อ คืนชื่อ job หรือ None ถ้าส่งไม่สำเร็จ
+    ไม่ใช้ context cache เพราะ job อาจรันหลัง cache หมดอายุ
+    """
+    prompts = [_build_prompt(item, context_data) for item in sar_items]
+    # ทุก request มีข้อมูลนำเข้าทั้งชุด ขนาดรวมจึงโตตามจำนวนหัวข้อ และ inline batch รับได้ไม่เกิน ~20MB
+    payload_bytes = sum(len(prompt.encode("utf-8")) for prompt in prompts)
+    if payload_bytes > BATCH_INLINE_MAX_BYTES:
+        st.error(
+            f"ข้อมูลสำหรับงาน Batch มีขนาด {payload_bytes / 1_000_000:.1f} MB เกินขีดจำกัด "
+            f"{BATCH_INLINE_MAX_BYTES / 1_000_000:.0f} MB กรุณาเลือกหัวข้อให้น้อยลง ลดไฟล์ที่อัปโหลด หรือปิดโหมด Batch"
+        )
+        return None
+
+    try:
+        client = _get_genai_client(api_key)
+        job = client.batches.create(
+            model="gemini-2.5-flash",
+            src=[
+                {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+                for prompt in prompts
+            ],
+            config={"display_name": "sar-generator"}
+        )
+        return job.name
+    except Exception as e:
+        st.error(f"An error occurred while creating the Gemini batch job: {e}")
+        return None
+
+def fetch_sar_batch_job(api_key, job_name):
+    """
+    ตรวจสถานะ batch job คืน (state, reports)
+    reports เป็น list ข้อความเรียงตามหัวข้อที่ส่งไป เมื่อ job สำเร็จแล้วเท่านั้น นอกนั้นเป็น None
+    """
+    client = _get_genai_client(api_key)
+    job = client.batches.get(name=job_name)
+    state = job.state.name
+    if state != "JOB_STATE_SUCCEEDED":
+        return state, None
+
+    reports = []
+    for inlined in job.dest.inlined_responses:
+        resp = inlined.response
+        reports.append(getattr(resp, "text", None) if resp else None)
+    return state, reports
+
+# ===================== Report storage =====================
+REPORT_DIR = Path(tempfile.gettempdir()) / "sar2022-reports"
+
+@st.cache_resource
+def _prepare_report_dir():
+    """
+    สร้างโฟลเดอร์ไฟล์รายงานของแอป และลบไฟล์ที่ค้างจากรอบก่อน (session ที่ปิดไปโดยไม่ได้ล้าง)
+    ทำครั้งเดียวต่อ process
+    """
+    REPORT_DIR.mkdir(parents=True, exist_ok=True)
+    cutoff = time.time() - REPORT_FILE_MAX_AGE_SECONDS
+    for path in REPORT_DIR.glob("*.md"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            pass
+    return REPORT_DIR
+
+def _clear_report():
+    path = st.session_state.report_output_path
+    if path:
+        Path(path).unlink(missing_ok=True)
+    st.session_state.report_output = ""
+    st.session_state.report_output_path = ""
+
+def _store_report(report):
+    """เก็บรายงานใน session_state รายงานที่ยาวเกิน REPORT_INLINE_MAX_CHARS เขียนลงไฟล์ชั่วคราวแล้วเก็บแค่ path"""
+    _clear_report()
+    if len(report) > REPORT_INLINE_MAX_CHARS:
+        report_dir = _prepare_report_dir()
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".md", dir=report_dir, delete=False) as tmp:
+            tmp.write(report)
+        st.session_state.report_output_path = tmp.name
+    else:
+        st.session_state.report_output = report
+
+def _load_report():
+    path = st.session_state.report_output_path
+    if path:
+        try:
+            return Path(path).read_text(encoding="utf-8")
+        except OSError:
+            return ""
+    return st.session_state.report_output
+
 # ===================== UI =====================
 
 
@@ -419,16 +974,16 @@ if not GEMINI_API_KEY:
         )
         st.stop()
 
+_prepare_report_dir()
+
 # --- Sidebar ---
 with st.sidebar:
     st.header("1. ป้อนข้อมูล")
     st.success("API Key ถูกโหลดเรียบร้อยแล้ว (ENV/secrets)")
 
-    sar_options = [f"{key}. {value}" for key, value in SAR_ITEMS.items()]
-    selected_option_str = st.selectbox(
-        "เลือกหัวข้อ SAR ที่ต้องการทำ (1-82)",
-        options=sar_options,
-        index=None,
+    selected_options = st.multiselect(
+        "เลือกหัวข้อ SAR ที่ต้องการทำ (1-82, เลือกได้หลายหัวข้อ)",
+        options=SAR_OPTIONS,
         placeholder="เลือกหัวข้อ..."
     )
 
@@ -445,6 +1000,11 @@ with st.sidebar:
         placeholder="เช่น ประเด็นที่ต้องการเน้นเป็นพิเศษ, ข้อมูลที่ไม่มีในเอกสาร..."
     )
 
+    batch_mode = st.checkbox(
+        "โหมด Batch (ประหยัดค่าใช้จ่าย)",
+        help="ส่งงานผ่าน Gemini Batch Mode ค่าใช้จ่ายต่ำกว่า แต่ต้องรอผลหลายนาที แล้วกด 'รีเฟรชสถานะ' เพื่อดูผล"
+    )
+
     generate_button = st.button("🚀 สร้างรายงาน SAR", use_container_width=True, type="primary")
 
     st.markdown("---")
@@ -454,7 +1014,7 @@ with st.sidebar:
         
         ### 🚀 4 ขั้นตอนง่ายๆ
         
-        1.  **เลือกหัวข้อ SAR** ที่คุณต้องการทำ
+        1.  **เลือกหัวข้อ SAR** ที่คุณต้องการทำ (เลือกได้หลายหัวข้อ)
         
         2.  **อัปโหลดไฟล์ที่เกี่ยวข้อง**
             * **สำคัญมาก:** เนื้อหาในไฟล์ต้องตรงกับหัวข้อที่เลือก มิฉะนั้น AI จะแจ้งว่า "ไม่พบเนื้อหาที่เกี่ยวข้อง"
@@ -482,26 +1042,70 @@ st.markdown("เครื่องมือช่วยสร้างราย
 st.markdown("---")
 if "report_output" not in st.session_state:
     st.session_state.report_output = ""
+if "report_output_path" not in st.session_state:
+    st.session_state.report_output_path = ""
+if "batch_job" not in st.session_state:
+    st.session_state.batch_job = None
 
 if generate_button:
-    if not selected_option_str:
+    if not selected_options:
         st.error("กรุณาเลือกหัวข้อ SAR ที่ต้องการทำ")
     elif not uploaded_files and not additional_context:
         st.error("กรุณาอัปโหลดไฟล์อย่างน้อย 1 ไฟล์ หรือใส่ข้อมูลเพิ่มเติม")
     else:
         with st.spinner("⏳ AI กำลังอ่านไฟล์และเรียบเรียงรายงาน..."):
-            context_data, files_ok = get_all_input_text(uploaded_files, additional_context)
-            if files_ok:
-                generated_report = generate_sar_section(GEMINI_API_KEY, selected_option_str, context_data)
+            context_data, files_ok = get_all_input_text(uploaded_files, additional_context, GEMINI_API_KEY)
+            if not files_ok:
+                st.error("ไม่สามารถดึงข้อมูลจากไฟล์ที่อัปโหลดได้ กรุณาตรวจสอบไฟล์อีกครั้ง")
+            elif batch_mode:
+                job_name = submit_sar_batch_job(GEMINI_API_KEY, selected_options, context_data)
+                if job_name:
+                    st.session_state.batch_job = {"name": job_name, "items": list(selected_options)}
+                    st.success(f"ส่งงาน Batch แล้ว ({job_name}) กด 'รีเฟรชสถานะ' เพื่อตรวจผล")
+                else:
+                    st.error("ไม่สามารถส่งงาน Batch ได้ กรุณาตรวจสอบข้อผิดพลาดและลองใหม่")
+            else:
+                if len(selected_options) == 1:
+                    stream_placeholder = st.empty()
+                    generated_report = generate_sar_section(
+                        GEMINI_API_KEY, selected_options[0], context_data, placeholder=stream_placeholder
+                    )
+                    # รายงานฉบับสมบูรณ์จะแสดงด้านล่างจาก session_state
+                    stream_placeholder.empty()
+                else:
+                    reports = generate_sar_sections(GEMINI_API_KEY, selected_options, context_data)
+                    generated_report = _format_reports(selected_options, reports)
                 if generated_report:
-                    st.session_state.report_output = generated_report
+                    _store_report(generated_report)
                 else:
-                    st.session_state.report_output = ""
+                    _clear_report()
                     st.error("ไม่สามารถสร้างรายงานได้ กรุณาตรวจสอบข้อผิดพลาดและลองใหม่")
+
+# --- Batch job ที่รอผล ---
+if st.session_state.batch_job:
+    job = st.session_state.batch_job
+    st.info(f"งาน Batch: {job['name']} ({len(job['items'])} หัวข้อ) กำลังรอผลจาก Gemini")
+    if st.button("🔄 รีเฟรชสถานะ"):
+        try:
+            state, reports = fetch_sar_batch_job(GEMINI_API_KEY, job["name"])
+        except Exception as e:
+            st.error(f"An error occurred while checking the Gemini batch job: {e}")
+        else:
+            if state == "JOB_STATE_SUCCEEDED":
+                st.session_state.batch_job = None
+                generated_report = _format_reports(job["items"], reports)
+                if generated_report:
+                    _store_report(generated_report)
+                else:
+                    st.error("งาน Batch เสร็จแล้วแต่ไม่มีผลลัพธ์ กรุณาลองใหม่")
+            elif state in BATCH_DONE_STATES:
+                st.session_state.batch_job = None
+                st.error(f"งาน Batch ไม่สำเร็จ (สถานะ: {state}) กรุณาลองใหม่")
             else:
-                st.error("ไม่สามารถดึงข้อมูลจากไฟล์ที่อัปโหลดได้ กรุณาตรวจสอบไฟล์อีกครั้ง")
+                st.info(f"สถานะปัจจุบัน: {state} กรุณารอสักครู่แล้วรีเฟรชอีกครั้ง")
 
-if st.session_state.report_output:
-    st.markdown(st.session_state.report_output)
+report_output = _load_report()
+if report_output:
+    st.markdown(report_output)
 else:
     st.info("กรุณาเลือกหัวข้อ, อัปโหลดไฟล์, และกดปุ่ม 'สร้างรายงาน SAR' เพื่อเริ่มต้น")